@@ -1,11 +1,104 @@
 import functions_framework
+import functools
+import hmac
 import logging
-import jsonschema
+import fastjsonschema
 import os
 import pandas as pd
 import numpy as np
 from flask import abort
 from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = prange = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pac
+    import requests
+except ImportError:
+    pa = pac = None
+
+if njit is not None:
+
+    @njit(parallel=True, cache=True)
+    def _mc_kernel(tp, simul, simul_days):
+        """Sum simul_days random throughput draws for each simulation
+        without materializing the full (simul, simul_days) matrix."""
+        n = tp.size
+        out = np.empty(simul, np.int64)
+        for i in prange(simul):
+            total = 0
+            for _ in range(simul_days):
+                total += tp[np.random.randint(0, n)]
+            out[i] = total
+        return out
+
+else:
+    _mc_kernel = None
+
+_FETCHER = ThreadPoolExecutor(max_workers=4)
+
+_TOKEN = os.environ.get('AUTH_BEARER_TOKEN')
+
+_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "Account_number": {"type": "integer"},
+        "Report_number": {"type": "integer"},
+        "Report_token": {"type": "string"},
+        "Cycletime": {
+            "type": "object",
+            "properties": {
+                "Percentiles": {
+                    "type": "array",
+                    "items": {
+                        "type": "number"
+                    },
+                    "minItems": 1,
+                    "maxItems": 5
+                }
+            },
+            "required": ["Percentiles"],
+            "minProperties": 1,
+            "maxProperties": 1
+        },
+        "Throughput_range": {"type": "integer"},
+        "Montecarlo": {
+            "type": "object",
+            "properties": {
+                "Simulations": {"type": "integer"},
+                "Simulation_days": {"type": "integer"},
+                "Percentiles": {
+                    "type": "array",
+                    "items": {
+                        "type": "number"
+                    },
+                    "minItems": 1,
+                    "maxItems": 5
+                }
+            },
+            "required": ["Simulations", "Simulation_days", "Percentiles"],
+            "minProperties": 3,
+            "maxProperties": 3
+        }
+    },
+    "required": ["Account_number", "Report_number", "Report_token", "Cycletime", "Throughput_range",  "Montecarlo"],
+    "minProperties": 6,
+    "maxProperties": 6
+
+}
+
+# Code-generated validator, compiled once at cold start
+_VALIDATE = fastjsonschema.compile(_SCHEMA)
+
+_URL_TMPL = (
+    "https://aod.eazybi.com/accounts/{a}/export/report/"
+    "{r}-api-export.csv?embed_token={t}"
+).format
 
 @functions_framework.http
 def main(request):
@@ -24,132 +117,121 @@ def main(request):
     """
     if check_authorization(request):
         cfg = request.get_json()
-        logging.warning(f"Json received: {cfg}")
+        logging.debug("Json received: %s", cfg)
+        # Start the network fetch while the schema validation runs; the
+        # url fields must already look valid since this races validation
+        fetch = None
+        if (
+            isinstance(cfg, dict)
+            and isinstance(cfg.get("Account_number"), int)
+            and isinstance(cfg.get("Report_number"), int)
+            and isinstance(cfg.get("Report_token"), str)
+        ):
+            fetch = _FETCHER.submit(get_eazybi_report, generate_url(cfg))
         config_error = test_config(cfg)
         if config_error:
+            if fetch is not None:
+                # Best effort: only stops the fetch if it has not started
+                fetch.cancel()
             return config_error
         else:
-            report_url = generate_url(cfg)
-            kanban_data = get_eazybi_report(report_url)
+            kanban_data = fetch.result(timeout=60)
             ct = calc_cycletime_percentile(cfg, kanban_data)
             today = date.today().strftime("%Y-%m-%d")
             past = date.today() - timedelta(days=cfg["Throughput_range"])
             past = past.strftime("%Y-%m-%d")
             tp = calc_throughput(kanban_data, past, today)
-            mc = run_simulation(cfg, tp)
-            mc = mc.rename(index={"issues": kanban_data.loc[0]["project"]})
-            result = ct.merge(mc, left_index=True, right_index=True)
+            mc = run_simulation(cfg, tp, name=kanban_data.loc[0]["project"])
+            result = ct.join(mc, how="inner")
             final_result = result.to_json(orient="table")
-            logging.warning(f"Result: {final_result}")
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("Result: %s", final_result)
             return final_result
     else:
-        logging.warning(f"Invalid token: {request.headers.get('Authorization')}")
+        logging.warning("Invalid token: %s", request.headers.get('Authorization'))
         return abort(401)
 
 def check_authorization(request):
-    if request.headers.get('Authorization') and os.environ.get('AUTH_BEARER_TOKEN'):
-        auth_token = request.headers.get('Authorization').replace('Bearer ', '')
-        if os.environ['AUTH_BEARER_TOKEN'] == auth_token:
-            return True
-        
-    return False
+    token = request.headers.get('Authorization', '')
+    if not _TOKEN or not token.startswith('Bearer '):
+        return False
+    return hmac.compare_digest(token[7:].encode(), _TOKEN.encode())
 
 def test_config(cfg):
         """Test config from json body"""
-        validation_schema = {
-            "type": "object",
-            "properties": {
-                "Account_number": {"type": "integer"},
-                "Report_number": {"type": "integer"},
-                "Report_token": {"type": "string"},
-                "Cycletime": {
-                    "type": "object",
-                    "properties": {
-                        "Percentiles": {
-                            "type": "array",
-                            "items": {
-                                "type": "number"
-                            },
-                            "minItems": 1,
-                            "maxItems": 5
-                        }
-                    },
-                    "required": ["Percentiles"],
-                    "minProperties": 1,
-                    "maxProperties": 1
-                },
-                "Throughput_range": {"type": "integer"},
-                "Montecarlo": {
-                    "type": "object",
-                    "properties": {
-                        "Simulations": {"type": "integer"},
-                        "Simulation_days": {"type": "integer"},
-                        "Percentiles": {
-                            "type": "array",
-                            "items": {
-                                "type": "number"
-                            },
-                            "minItems": 1,
-                            "maxItems": 5
-                        }
-                    },
-                    "required": ["Simulations", "Simulation_days", "Percentiles"],
-                    "minProperties": 3,
-                    "maxProperties": 3
-                }
-            },
-            "required": ["Account_number", "Report_number", "Report_token", "Cycletime", "Throughput_range",  "Montecarlo"],
-            "minProperties": 6,
-            "maxProperties": 6
-
-        }
-        
         try:
-            jsonschema.validate(instance=cfg, schema=validation_schema)
-        except jsonschema.exceptions.ValidationError as err:
-            logging.warning(f"Json validation error: {err}")
+            _VALIDATE(cfg)
+        except fastjsonschema.JsonSchemaException as err:
+            logging.warning("Json validation error: %s", err)
             return {
                 "message": {
                     "json_body": "You invalid entries in config Json",
                 }
             }
 
+@functools.lru_cache(maxsize=256)
+def _build_url(account, report, token):
+    return _URL_TMPL(a=account, r=report, t=token)
+
 def generate_url(cfg):
     """Generate a url to fetch eazybi data"""
-    url = (
-        "https://aod.eazybi.com/accounts/"
-        + str(cfg["Account_number"])
-        + "/export/report/"
-        + str(cfg["Report_number"])
-        + "-api-export.csv?embed_token="
-        + str(cfg["Report_token"])
+    return _build_url(
+        cfg["Account_number"], cfg["Report_number"], cfg["Report_token"]
     )
-    return url
 
 def get_eazybi_report(report_url):
     """Capture eazybi data from an url and convert to a dictionary"""
-    dictio = pd.read_csv(report_url, delimiter=",", parse_dates=["Time"])
+    if pa is not None:
+        response = requests.get(report_url, timeout=30)
+        response.raise_for_status()
+        buf = pa.BufferReader(response.content)
+        table = pac.read_csv(
+            buf,
+            parse_options=pac.ParseOptions(delimiter=","),
+            convert_options=pac.ConvertOptions(
+                column_types={"Time": pa.timestamp("ns")}
+            ),
+        )
+        # Rename on the columnar table and convert without block
+        # consolidation; downstream numpy kernels read the column
+        # buffers zero-copy
+        table = table.rename_columns(["project", "date", "issue", "cycletime"])
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+    else:
+        dictio = pd.read_csv(report_url, delimiter=",")
+        # Known ISO format + cache beats dateutil guessing each row,
+        # and repeated dates resolve through the cache
+        dictio["Time"] = pd.to_datetime(
+            dictio["Time"], format="%Y-%m-%d", cache=True
+        )
     dictio.columns = ["project", "date", "issue", "cycletime"]
     return dictio
 
 def calc_cycletime_percentile(cfg, kanban_data):
     """Calculate cycletime percentiles on cfg with all dict entries"""
     if not kanban_data.empty:
-        cycletime = None
-        for cfg_percentile in cfg["Cycletime"]["Percentiles"]:
-            temp_cycletime = (
-                kanban_data.groupby("project")
-                .cycletime.quantile(cfg_percentile / 100)
-                .rename("cycletime " + str(cfg_percentile) + "%")
-                .apply(np.ceil)
-                .astype("int")
+        quantiles = np.asarray(cfg["Cycletime"]["Percentiles"]) / 100.0
+        columns = [
+            "cycletime " + str(p) + "%" for p in cfg["Cycletime"]["Percentiles"]
+        ]
+        groups = kanban_data.groupby("project", sort=False).cycletime
+        matrix = np.empty((groups.ngroups, quantiles.size))
+        projects = []
+        for row, (project, group) in enumerate(groups):
+            projects.append(project)
+            matrix[row] = np.nanquantile(group.to_numpy(), quantiles)
+        np.ceil(matrix, out=matrix)
+        # A project with only blank cycletimes yields NaN quantiles;
+        # raise like pandas astype did instead of casting to INT64_MIN
+        if np.isnan(matrix).any():
+            raise pd.errors.IntCastingNaNError(
+                "Cannot convert non-finite values (NA or inf) to integer"
             )
-            if cycletime is None:
-                cycletime = pd.DataFrame(temp_cycletime)
-            else:
-                cycletime = pd.merge(
-                    cycletime, temp_cycletime, left_index=True, right_index=True
-                )
+        cycletime = pd.DataFrame(
+            matrix.astype("int"),
+            index=pd.Index(projects, name="project"),
+            columns=columns,
+        )
         return cycletime
 
 def calc_throughput(kanban_data, start_date=None, end_date=None):
@@ -168,27 +250,40 @@ def calc_throughput(kanban_data, start_date=None, end_date=None):
             final date of the throughput
     """
     if "date" in kanban_data.columns:
-        if start_date is not None:
-            kanban_data = kanban_data[kanban_data["date"] >= start_date]
-        if end_date is not None:
-            kanban_data = kanban_data[kanban_data["date"] <= end_date]
+        if start_date is not None or end_date is not None:
+            # A sorted date column turns the range filter into one
+            # binary-search slice instead of two boolean-mask scans
+            if not kanban_data["date"].is_monotonic_increasing:
+                kanban_data = kanban_data.sort_values("date", kind="mergesort")
+            dates = kanban_data["date"]
+            lo = (
+                dates.searchsorted(start_date, side="left")
+                if start_date is not None
+                else 0
+            )
+            hi = (
+                dates.searchsorted(end_date, side="right")
+                if end_date is not None
+                else len(dates)
+            )
+            kanban_data = kanban_data.iloc[lo:hi]
         if kanban_data.empty is False:
             # Reorganize DataFrame
-            throughput = pd.crosstab(
-                kanban_data.date, columns=["issues"], colnames=[None]
-            ).reset_index()
-            if throughput.empty is False and (
-                start_date is not None and end_date is not None
-            ):
+            throughput = (
+                kanban_data["date"].value_counts().sort_index().rename("issues")
+            )
+            if start_date is not None and end_date is not None:
                 date_range = pd.date_range(start=start_date, end=end_date)
                 throughput = (
-                    throughput.set_index("date")
-                    .reindex(date_range, fill_value=0)
+                    throughput.reindex(date_range, fill_value=0)
                     .rename_axis("Date")
+                    .to_frame()
                 )
+            else:
+                throughput = throughput.rename_axis("date").reset_index()
             return throughput
 
-def run_simulation(cfg, throughput, simul=None, simul_days=None):
+def run_simulation(cfg, throughput, simul=None, simul_days=None, name="issues"):
     """Run monte carlo simulation with the result of how many itens will
     be delivered in a set of days
 
@@ -200,6 +295,8 @@ def run_simulation(cfg, throughput, simul=None, simul_days=None):
             number of simulations
         simul_days : integer
             days to run the simulation
+        name : string
+            label of the result row, usually the project name
     """
     if simul is None:
         simul = cfg["Montecarlo"]["Simulations"]
@@ -207,30 +304,35 @@ def run_simulation(cfg, throughput, simul=None, simul_days=None):
         simul_days = cfg["Montecarlo"]["Simulation_days"]
 
     if throughput is not None:
-        dataset = throughput[["issues"]].reset_index(drop=True)
-        samples = [
-            getattr(dataset.sample(n=simul_days, replace=True).sum(), "issues")
-            for _ in range(simul)
+        tp = throughput["issues"].to_numpy(dtype=np.int32)
+        if _mc_kernel is not None:
+            samples = _mc_kernel(tp, simul, simul_days)
+        else:
+            rng = np.random.default_rng()
+            idx = rng.integers(
+                0, tp.size, size=(simul, simul_days), dtype=np.int32
+            )
+            samples = tp[idx].sum(axis=1, dtype=np.int64)
+        items, freq = np.unique(samples, return_counts=True)
+        items = items[::-1]
+        freq = freq[::-1]
+        prob = 100.0 * np.cumsum(freq) / freq.sum()
+        # Get nearest neighbor result; prob is monotonic increasing so
+        # binary search finds every percentile in one vectorized call
+        targets = np.asarray(cfg["Montecarlo"]["Percentiles"], dtype=np.float64)
+        idx = np.clip(np.searchsorted(prob, targets), 1, prob.size - 1)
+        idx = np.where(
+            np.abs(prob[idx - 1] - targets) <= np.abs(prob[idx] - targets),
+            idx - 1,
+            idx,
+        )
+        columns = [
+            "montecarlo " + str(p) + "%"
+            for p in cfg["Montecarlo"]["Percentiles"]
         ]
-        samples = pd.DataFrame(samples, columns=["Items"])
-        distribution = (
-            samples.groupby(["Items"]).size().reset_index(name="Frequency")
+        mc = pd.DataFrame(
+            items[idx].astype(np.int64)[None, :], index=[name], columns=columns
         )
-        distribution = distribution.sort_index(ascending=False)
-        distribution["Probability"] = (
-            100 * distribution.Frequency.cumsum()
-        ) / distribution.Frequency.sum()
-        mc_results = {}
-        # Get nearest neighbor result
-        for percentil in cfg["Montecarlo"]["Percentiles"]:
-            result_index = distribution["Probability"].sub(percentil).abs().idxmin()
-            mc_results["montecarlo " + str(percentil) + "%"] = distribution.loc[
-                result_index, "Items"
-            ]
-
-            mc = pd.DataFrame.from_dict(
-                mc_results, orient="index", columns=["issues"]
-            ).transpose()
         return mc
     else:
         return None